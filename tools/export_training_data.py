@@ -7,8 +7,103 @@ Converts JSON logs to PyTorch-ready tensor datasets
 import json
 import numpy as np
 import argparse
+from collections import Counter
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    _json_loads = json.loads
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fall back to NumPy column fills
+    njit = None
+    prange = range
+
+
+# Weather name -> one-hot row; unknown weather maps to the all-zero row
+WEATHER_IDX = {'clear': 0, 'rain': 1, 'storm': 2}
+WEATHER_UNKNOWN = len(WEATHER_IDX)
+WEATHER_ONEHOT = np.vstack([np.eye(3), np.zeros((1, 3))]).astype(np.float32)
+
+NUM_FEATURES = 13
+
+# Action type -> class label
+_ACTION_MAP = {
+    'idle': 0,
+    'move': 1,
+    'forage': 2,
+    'eat': 3,
+    'rest': 4,
+    'explore': 5,
+    'socialize': 6,
+    'build_shelter': 7,
+    'seek_shelter': 8
+}
+
+
+def iter_jsonl(path, chunk_size: int = 8 << 20) -> Iterator[Dict[str, Any]]:
+    """Yield parsed entries from a JSONL file, skipping malformed lines
+    
+    The file is read in large binary chunks and split on newlines, with the
+    trailing partial line carried over into the next chunk.
+    """
+    residual = b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (residual + chunk).split(b'\n')
+            residual = lines.pop()
+            for line in lines:
+                if not line:
+                    continue
+                try:
+                    yield _json_loads(line)
+                except json.JSONDecodeError:  # orjson's error subclasses this
+                    continue
+    
+    if residual:
+        try:
+            yield _json_loads(residual)
+        except json.JSONDecodeError:
+            pass
+
+
+def _fill_features_loop(out, needs, time_of_day, weather_idx, weather_onehot,
+                        food_count, shelter_count, npc_count, memory_count):
+    """Write normalized feature rows into out; each iteration owns one row"""
+    for i in prange(out.shape[0]):
+        for j in range(5):
+            out[i, j] = needs[i, j]
+        out[i, 5] = time_of_day[i]
+        out[i, 6:9] = weather_onehot[weather_idx[i]]
+        out[i, 9] = min(food_count[i] / 10.0, 1.0)
+        out[i, 10] = min(shelter_count[i] / 10.0, 1.0)
+        out[i, 11] = min(npc_count[i] / 10.0, 1.0)
+        out[i, 12] = min(memory_count[i] / 5.0, 1.0)
+
+
+def _fill_features_numpy(out, needs, time_of_day, weather_idx, weather_onehot,
+                         food_count, shelter_count, npc_count, memory_count):
+    """Write normalized feature rows into out by column slab"""
+    out[:, 0:5] = needs
+    out[:, 5] = time_of_day
+    out[:, 6:9] = weather_onehot[weather_idx]
+    out[:, 9] = np.minimum(food_count / 10.0, 1.0)
+    out[:, 10] = np.minimum(shelter_count / 10.0, 1.0)
+    out[:, 11] = np.minimum(npc_count / 10.0, 1.0)
+    out[:, 12] = np.minimum(memory_count / 5.0, 1.0)
+
+
+if njit is not None:
+    _fill_features = njit(parallel=True, cache=True, fastmath=True)(_fill_features_loop)
+else:
+    _fill_features = _fill_features_numpy
 
 
 class DataProcessor:
@@ -22,25 +117,12 @@ class DataProcessor:
         decisions_file = self.log_dir / "decisions.jsonl"
         events_file = self.log_dir / "events.jsonl"
         
-        if decisionsfile.exists():
-            with open(decisions_file, 'r') as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        if 'tick' in data:  # Only process decision entries (skip schema version line)
-                            self.decisions.append(data)
-                    except json.JSONDecodeError:
-                        continue
+        # Only keep entries with a tick (skips the schema version line)
+        if decisions_file.exists():
+            self.decisions.extend(d for d in iter_jsonl(decisions_file) if 'tick' in d)
         
         if events_file.exists():
-            with open(events_file, 'r') as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        if 'tick' in data:
-                            self.events.append(data)
-                    except json.JSONDecodeError:
-                        continue
+            self.events.extend(e for e in iter_jsonl(events_file) if 'tick' in e)
         
         print(f"Loaded {len(self.decisions)} decisions and {len(self.events)} events")
     
@@ -63,11 +145,7 @@ class DataProcessor:
         
         # Weather encoding (3 values - one-hot)
         weather = perception['weather']
-        features.extend([
-            1.0 if weather == 'clear' else 0.0,
-            1.0 if weather == 'rain' else 0.0,
-            1.0 if weather == 'storm' else 0.0
-        ])
+        features.extend(WEATHER_ONEHOT[WEATHER_IDX.get(weather, WEATHER_UNKNOWN)].tolist())
         
         # Count of nearby tiles by type (simplified)
         food_count = sum(1 for tile in perception['nearby_tiles'] if tile['type'] == 'food')
@@ -87,44 +165,81 @@ class DataProcessor:
         
         return np.array(features, dtype=np.float32)
     
+    def _fill_dataset(self, X: np.ndarray, y: np.ndarray):
+        """Fill preallocated (N, 13) features and (N,) labels in one pass"""
+        needs_rows = []
+        time_of_day = []
+        weather_idx = []
+        food_counts = []
+        shelter_counts = []
+        npc_counts = []
+        memory_counts = []
+        
+        encode = _ACTION_MAP.get
+        
+        # Pull raw scalars out of the JSON dicts once
+        for i, decision in enumerate(self.decisions):
+            y[i] = encode(decision['decision']['type'], 0)
+            
+            perception = decision['perception']
+            needs = perception['internal_needs']
+            needs_rows.append((needs['hunger'], needs['energy'], needs['social'],
+                               needs['curiosity'], needs['safety']))
+            time_of_day.append(perception['time_of_day'])
+            weather_idx.append(WEATHER_IDX.get(perception['weather'], WEATHER_UNKNOWN))
+            
+            food = shelter = 0
+            for tile in perception['nearby_tiles']:
+                tile_type = tile['type']
+                if tile_type == 'food':
+                    food += 1
+                elif tile_type == 'shelter':
+                    shelter += 1
+            food_counts.append(food)
+            shelter_counts.append(shelter)
+            npc_counts.append(len(perception['nearby_npcs']))
+            memory_counts.append(len(perception['memory_recalls']))
+        
+        _fill_features(
+            X,
+            np.asarray(needs_rows, dtype=np.float32).reshape(-1, 5),
+            np.asarray(time_of_day, dtype=np.float32),
+            np.asarray(weather_idx, dtype=np.intp),
+            WEATHER_ONEHOT,
+            np.asarray(food_counts, dtype=np.int64),
+            np.asarray(shelter_counts, dtype=np.int64),
+            np.asarray(npc_counts, dtype=np.int64),
+            np.asarray(memory_counts, dtype=np.int64)
+        )
+    
     def encode_action(self, decision: Dict[str, Any]) -> int:
         """Encode action type as integer label"""
-        action_map = {
-            'idle': 0,
-            'move': 1,
-            'forage': 2,
-            'eat': 3,
-            'rest': 4,
-            'explore': 5,
-            'socialize': 6,
-            'build_shelter': 7,
-            'seek_shelter': 8
-        }
-        return action_map.get(decision['type'], 0)
+        return _ACTION_MAP.get(decision['type'], 0)
     
-    def create_dataset(self, output_dir: str = "training_data"):
-        """Create numpy arrays for PyTorch training"""
+    def create_dataset(self, output_dir: str = "training_data", compress: bool = False):
+        """Create numpy arrays for PyTorch training
+        
+        With compress, an LZ4-compressed features.joblib is written as well,
+        for archiving or copying; features.npy stays the file to memory-map.
+        """
         output_path = Path(output_dir)
         output_path.mkdir(exist_ok=True)
         
-        features_list = []
-        labels_list = []
+        # Features are written straight into the memory-mapped output file
+        num_samples = len(self.decisions)
+        X = np.lib.format.open_memmap(output_path / 'features.npy', mode='w+',
+                                      dtype=np.float32, shape=(num_samples, NUM_FEATURES))
+        y = np.empty(num_samples, dtype=np.int64)
         
-        for decision in self.decisions:
-            features = self.extract_features(decision['perception'])
-            label = self.encode_action(decision['decision'])
-            
-            features_list.append(features)
-            labels_list.append(label)
-        
-        # Convert to numpy arrays
-        X = np.array(features_list, dtype=np.float32)
-        y = np.array(labels_list, dtype=np.int64)
+        self._fill_dataset(X, y)
         
-        # Save as numpy files
-        np.save(output_path / 'features.npy', X)
+        X.flush()
         np.save(output_path / 'labels.npy', y)
         
+        if compress:
+            from joblib import dump
+            dump(np.asarray(X), output_path / 'features.joblib', compress=('lz4', 3))
+        
         # Save metadata
         metadata = {
             'num_samples': len(X),
@@ -158,20 +273,20 @@ class DataProcessor:
             print("No decisions to analyze")
             return
         
-        action_counts = {}
-        for decision in self.decisions:
-            action = decision['decision']['type']
-            action_counts[action] = action_counts.get(action, 0) + 1
+        action_counts = Counter(d['decision']['type'] for d in self.decisions)
         
         print("\nAction distribution:")
-        for action, count in sorted(action_counts.items(), key=lambda x: x[1], reverse=True):
+        for action, count in action_counts.most_common():
             percentage = (count / len(self.decisions)) * 100
             print(f"  {action}: {count} ({percentage:.1f}%)")
         
-        # Average needs
-        avg_hunger = np.mean([d['perception']['internal_needs']['hunger'] for d in self.decisions])
-        avg_energy = np.mean([d['perception']['internal_needs']['energy'] for d in self.decisions])
-        avg_social = np.mean([d['perception']['internal_needs']['social'] for d in self.decisions])
+        # Average needs, gathered in a single pass over the decisions
+        needs = np.fromiter(
+            (d['perception']['internal_needs'][k]
+             for d in self.decisions for k in ('hunger', 'energy', 'social')),
+            dtype=np.float64, count=3 * len(self.decisions)
+        ).reshape(-1, 3)
+        avg_hunger, avg_energy, avg_social = needs.mean(axis=0)
         
         print(f"\nAverage needs:")
         print(f"  Hunger: {avg_hunger:.3f}")
@@ -184,6 +299,8 @@ def main():
     parser.add_argument('--log-dir', default='data_logs', help='Directory containing log files')
     parser.add_argument('--output-dir', default='training_data', help='Output directory for processed data')
     parser.add_argument('--stats', action='store_true', help='Print statistics only')
+    parser.add_argument('--compress', action='store_true',
+                        help='Also write LZ4-compressed features.joblib (requires joblib and lz4)')
     
     args = parser.parse_args()
     
@@ -192,7 +309,7 @@ def main():
     processor.print_statistics()
     
     if not args.stats:
-        processor.create_dataset(args.output_dir)
+        processor.create_dataset(args.output_dir, compress=args.compress)
 
 
 if __name__ == '__main__':
@@ -5,31 +5,124 @@ Fine-tune NPC Brain - Create unique personalities from individual experience log
 import argparse
 import json
 import os
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, Subset
 from pathlib import Path
 import sys
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from model_architecture import create_model
-from train_npc_brain import NPCDataset, train_epoch, validate, export_to_onnx
+from train_npc_brain import (NPCDataset, train_epoch, validate, export_to_onnx, quantize_onnx,
+                             compile_for_training, bf16_autocast_dtype, make_loader)
 
 
-class PersonalizedNPCDataset(NPCDataset):
-    """Dataset filtered for specific NPC ID"""
+class PersonalizedNPCDataset(Subset):
+    """View of one NPC's samples in an NPCDataset
     
-    def __init__(self, data_dir, npc_id, perception_dim=20, memory_seq_len=50, memory_dim=32):
-        super().__init__(data_dir, perception_dim, memory_seq_len, memory_dim)
-        
-        # Filter samples for specific NPC
-        self.samples = [s for s in self.samples if s.get('npcId') == npc_id]
-        print(f"Filtered to {len(self.samples)} samples for NPC {npc_id}")
+    Pass an already loaded NPCDataset as base_dataset to view its samples
+    for this NPC instead of re-reading the logs.
+    """
+    
+    def __init__(self, data_dir, npc_id, perception_dim=20, memory_seq_len=50, memory_dim=32,
+                 base_dataset=None):
+        if base_dataset is None:
+            base_dataset = NPCDataset(data_dir, perception_dim, memory_seq_len, memory_dim,
+                                      npc_id_filter=npc_id)
+        super().__init__(base_dataset, base_dataset.indices_for(npc_id))
+        print(f"Filtered to {len(self)} samples for NPC {npc_id}")
+
+
+class MultiNPCDataset(NPCDataset):
+    """Dataset covering several NPCs, tagging each sample with its personality index"""
+    
+    def __init__(self, data_dir, npc_ids, perception_dim=20, memory_seq_len=50, memory_dim=32):
+        super().__init__(data_dir, perception_dim, memory_seq_len, memory_dim,
+                         npc_id_filter=set(npc_ids))
+        self.npc_ids = list(npc_ids)
+        self.npc_index = {npc_id: i for i, npc_id in enumerate(self.npc_ids)}
+        self.personality = np.array([self.npc_index[npc_id] for npc_id in self.sample_npc_ids],
+                                    dtype=np.int64)
+        print(f"Filtered to {len(self)} samples for NPCs {self.npc_ids}")
+    
+    def __getitem__(self, idx):
+        item = super().__getitem__(idx)
+        item['npc_index'] = torch.from_numpy(self.personality[idx, ...])
+        return item
 
 
-def fine_tune(base_model_path, npc_id, data_dir, output_dir, epochs=20, lr=0.0001, device='cpu'):
-    """Fine-tune base model on individual NPC's experience"""
+def personality_state_dict(model, npc_index):
+    """Standalone state dict for one NPC of a multi-NPC model
+    
+    The NPC embedding is added right after the last perception_encoder layer, so it folds
+    into that layer's bias and the result loads into a plain create_model().
+    """
+    state = {k: v.detach().clone() for k, v in model.state_dict().items()
+             if not k.startswith('npc_embedding.')}
+    state['perception_encoder.3.bias'] += model.npc_embedding.weight[npc_index].detach()
+    return state
+
+
+def _make_loader(dataset, device):
+    """Shuffled fine-tuning loader over the in-memory samples"""
+    return make_loader(dataset, 8, device, shuffle=True)
+
+
+def _split_holdout(indices, max_holdout=256):
+    """Split sample indices into (train, holdout)
+    
+    The holdout is the most recent tenth of the samples, capped at
+    max_holdout; it is kept out of training so the int8 agreement check
+    runs on unseen data.
+    """
+    indices = list(indices)
+    split = len(indices) - min(max_holdout, len(indices) // 10)
+    return indices[:split], indices[split:]
+
+
+def check_quantized_agreement(fp32_path, int8_path, dataset):
+    """Fraction of samples where the int8 model picks the same action as FP32"""
+    import onnxruntime as ort
+    
+    if len(dataset) == 0:
+        return None
+    samples = [dataset[i] for i in range(len(dataset))]
+    inputs = {
+        'perception': np.stack([s['perception'].numpy() for s in samples]),
+        'memory': np.stack([s['memory'].numpy() for s in samples])
+    }
+    
+    # The first 9 output columns are the action probabilities
+    fp32_probs = ort.InferenceSession(fp32_path).run(None, inputs)[0][:, :9]
+    int8_probs = ort.InferenceSession(int8_path).run(None, inputs)[0][:, :9]
+    return float(np.mean(fp32_probs.argmax(axis=1) == int8_probs.argmax(axis=1)))
+
+
+def _export_personality(model, npc_id, output_dir, holdout):
+    """Export one NPC's brain to ONNX plus an int8 copy for the runtime
+    
+    holdout holds samples excluded from fine-tuning, used to score the int8 copy.
+    """
+    onnx_path = os.path.join(output_dir, f'npc_brain_{npc_id}.onnx')
+    export_to_onnx(model, onnx_path)
+    
+    int8_path = quantize_onnx(onnx_path)
+    agreement = check_quantized_agreement(onnx_path, int8_path, holdout)
+    if agreement is not None:
+        print(f"Int8 action agreement with FP32 on {len(holdout)} held-out samples: "
+              f"{agreement * 100:.1f}%")
+
+
+def fine_tune(base_model_path, npc_id, data_dir, output_dir, epochs=20, lr=0.0001, device='cpu',
+              compile_model=None, base_dataset=None):
+    """Fine-tune base model on individual NPC's experience
+    
+    When fine-tuning many NPCs back to back, load one NPCDataset up front and
+    pass it as base_dataset so the logs are parsed only once.
+    """
+    device = torch.device(device)
     
     # Load base model
     print(f"Loading base model from {base_model_path}...")
@@ -39,27 +132,35 @@ def fine_tune(base_model_path, npc_id, data_dir, output_dir, epochs=20, lr=0.000
     
     # Load personalized dataset
     print(f"Loading data for NPC {npc_id}...")
-    dataset = PersonalizedNPCDataset(data_dir, npc_id)
+    dataset = PersonalizedNPCDataset(data_dir, npc_id, base_dataset=base_dataset)
     
     if len(dataset) < 10:
         print(f"Warning: Only {len(dataset)} samples for NPC {npc_id}, "
               f"fine-tuning may not be effective")
     
-    # Create data loader
-    train_loader = DataLoader(dataset, batch_size=8, shuffle=True)
+    # Hold back the newest samples for the int8 agreement check
+    train_indices, holdout_indices = _split_holdout(range(len(dataset)))
+    train_loader = _make_loader(Subset(dataset, train_indices), device)
     
     # Optimizer with lower learning rate for fine-tuning
-    optimizer = optim.Adam(model.parameters(), lr=lr)
+    optimizer = optim.Adam(model.parameters(), lr=lr, fused=(device.type == 'cuda'))
     criterion_action = nn.CrossEntropyLoss()
     criterion_emotion = nn.MSELoss()
     
+    # Compiled copy for training only; the first step triggers compilation,
+    # so epoch 1 runs slower
+    train_model = compile_for_training(model, device, compile_model)
+    # bf16 autocast on Ampere+ GPUs; older GPUs and CPU fine-tune in FP32
+    amp_dtype = bf16_autocast_dtype(device)
+    
     # Fine-tuning loop
     print(f"\nFine-tuning for {epochs} epochs...")
     best_loss = float('inf')
     
     for epoch in range(epochs):
         train_loss, train_action_loss, train_emotion_loss, train_acc = train_epoch(
-            model, train_loader, optimizer, criterion_action, criterion_emotion, device
+            train_model, train_loader, optimizer, criterion_action, criterion_emotion, device,
+            amp_dtype
         )
         
         print(f"Epoch {epoch+1}/{epochs}: Loss: {train_loss:.4f}, Acc: {train_acc:.2f}%")
@@ -70,20 +171,93 @@ def fine_tune(base_model_path, npc_id, data_dir, output_dir, epochs=20, lr=0.000
             output_path = os.path.join(output_dir, f'npc_brain_{npc_id}.pth')
             torch.save(model.state_dict(), output_path)
     
-    # Export to ONNX
-    onnx_path = os.path.join(output_dir, f'npc_brain_{npc_id}.onnx')
-    export_to_onnx(model, onnx_path)
+    _export_personality(model, npc_id, output_dir, Subset(dataset, holdout_indices))
     
     print(f"\nFine-tuning complete for NPC {npc_id}!")
     print(f"Personalized model saved to {output_dir}/")
 
 
+def fine_tune_many(base_model_path, npc_ids, data_dir, output_dir, epochs=20, lr=0.0001,
+                   device='cpu', compile_model=None):
+    """Fine-tune several NPCs at once with a shared model and per-NPC embeddings"""
+    device = torch.device(device)
+    npc_ids = list(npc_ids)
+    
+    # Load base model; the NPC embedding is new and starts at zero
+    print(f"Loading base model from {base_model_path}...")
+    model = create_model(num_npcs=len(npc_ids))
+    missing, unexpected = model.load_state_dict(
+        torch.load(base_model_path, map_location=device), strict=False)
+    if unexpected or any(not k.startswith('npc_embedding.') for k in missing):
+        raise RuntimeError(f"Base model does not match architecture "
+                           f"(missing: {missing}, unexpected: {unexpected})")
+    model = model.to(device)
+    
+    # Load the union of all requested NPCs' data
+    print(f"Loading data for NPCs {npc_ids}...")
+    dataset = MultiNPCDataset(data_dir, npc_ids)
+    
+    # Hold back each NPC's newest samples for its int8 agreement check
+    train_indices, holdouts = [], {}
+    for npc_id in npc_ids:
+        count = len(dataset.indices_for(npc_id))
+        if count < 10:
+            print(f"Warning: Only {count} samples for NPC {npc_id}, "
+                  f"fine-tuning may not be effective")
+        npc_train, holdouts[npc_id] = _split_holdout(dataset.indices_for(npc_id))
+        train_indices.extend(npc_train)
+    
+    train_loader = _make_loader(Subset(dataset, train_indices), device)
+    
+    optimizer = optim.Adam(model.parameters(), lr=lr, fused=(device.type == 'cuda'))
+    criterion_action = nn.CrossEntropyLoss()
+    criterion_emotion = nn.MSELoss()
+    
+    # Compiled copy and precision as in fine_tune
+    train_model = compile_for_training(model, device, compile_model)
+    amp_dtype = bf16_autocast_dtype(device)
+    
+    # Fine-tuning loop; minibatches mix NPCs
+    print(f"\nFine-tuning {len(npc_ids)} NPCs for {epochs} epochs...")
+    best_loss = float('inf')
+    
+    for epoch in range(epochs):
+        train_loss, train_action_loss, train_emotion_loss, train_acc = train_epoch(
+            train_model, train_loader, optimizer, criterion_action, criterion_emotion, device,
+            amp_dtype
+        )
+        
+        print(f"Epoch {epoch+1}/{epochs}: Loss: {train_loss:.4f}, Acc: {train_acc:.2f}%")
+        
+        if train_loss < best_loss:
+            best_loss = train_loss
+            # Save combined model holding every personality
+            torch.save(model.state_dict(), os.path.join(output_dir, 'npc_brain_multi.pth'))
+    
+    # Split into standalone per-NPC models
+    for npc_index, npc_id in enumerate(npc_ids):
+        npc_model = create_model()
+        npc_model.load_state_dict(personality_state_dict(model, npc_index))
+        torch.save(npc_model.state_dict(), os.path.join(output_dir, f'npc_brain_{npc_id}.pth'))
+        
+        _export_personality(npc_model, npc_id, output_dir, Subset(dataset, holdouts[npc_id]))
+    
+    print(f"\nFine-tuning complete for NPCs {npc_ids}!")
+    print(f"Personalized models saved to {output_dir}/")
+
+
 def main():
     parser = argparse.ArgumentParser(description='Fine-tune NPC Brain for specific personality')
     parser.add_argument('--base-model', type=str, required=True,
                         help='Path to base trained model (.pth file)')
-    parser.add_argument('--npc-id', type=int, required=True,
-                        help='NPC ID to fine-tune for')
+    npc_group = parser.add_mutually_exclusive_group(required=True)
+    npc_group.add_argument('--npc-id', type=int,
+                           help='NPC ID to fine-tune for')
+    npc_group.add_argument('--npc-ids', type=str,
+                           help='Comma-separated NPC IDs to fine-tune together (e.g. 1,2,3)')
+    parser.add_argument('--separate', action='store_true',
+                        help='With --npc-ids, fine-tune an independent model per NPC '
+                             'from logs parsed once')
     parser.add_argument('--data-dir', type=str, default='data_logs',
                         help='Directory containing training data')
     parser.add_argument('--output-dir', type=str, default='models',
@@ -94,6 +268,10 @@ def main():
                         help='Learning rate (lower than base training)')
     parser.add_argument('--device', type=str, default='cpu',
                         help='Device to use (cpu or cuda)')
+    parser.add_argument('--compile', dest='compile_model', action='store_const', const=True,
+                        default=None, help='Train through torch.compile (default: CUDA only)')
+    parser.add_argument('--no-compile', dest='compile_model', action='store_const', const=False,
+                        help='Never use torch.compile')
     
     args = parser.parse_args()
     
@@ -105,6 +283,37 @@ def main():
     print(f"Using device: {device}")
     
     # Fine-tune
+    if args.npc_ids:
+        npc_ids = [int(x) for x in args.npc_ids.split(',') if x.strip()]
+        if args.separate:
+            # Parse the logs once and view each NPC's samples from it
+            base_dataset = NPCDataset(args.data_dir, npc_id_filter=set(npc_ids))
+            for npc_id in npc_ids:
+                fine_tune(
+                    args.base_model,
+                    npc_id,
+                    args.data_dir,
+                    args.output_dir,
+                    args.epochs,
+                    args.lr,
+                    device,
+                    args.compile_model,
+                    base_dataset
+                )
+            return
+        
+        fine_tune_many(
+            args.base_model,
+            npc_ids,
+            args.data_dir,
+            args.output_dir,
+            args.epochs,
+            args.lr,
+            device,
+            args.compile_model
+        )
+        return
+    
     fine_tune(
         args.base_model,
         args.npc_id,
@@ -112,7 +321,8 @@ def main():
         args.output_dir,
         args.epochs,
         args.lr,
-        device
+        device,
+        args.compile_model
     )
 
 
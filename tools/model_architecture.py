@@ -9,17 +9,31 @@ import torch.nn.functional as F
 import math
 
 
-class PositionalEncoding(nn.Module):
-    """Positional encoding for transformer"""
-    def __init__(self, d_model, max_len=50):
-        super().__init__()
+# Sinusoidal tables keyed by (max_len, d_model), shared across model instances
+_PE_CACHE = {}
+
+
+def _sinusoidal_table(max_len, d_model):
+    """Return the (1, max_len, d_model) sin/cos table, building it once per shape"""
+    key = (max_len, d_model)
+    pe = _PE_CACHE.get(key)
+    if pe is None:
         pe = torch.zeros(max_len, d_model)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
         pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
+        _PE_CACHE[key] = pe
+    return pe
+
+
+class PositionalEncoding(nn.Module):
+    """Positional encoding for transformer"""
+    def __init__(self, d_model, max_len=50):
+        super().__init__()
+        # Clone so load_state_dict/in-place ops never touch the shared table
+        self.register_buffer('pe', _sinusoidal_table(max_len, d_model).clone())
     
     def forward(self, x):
         # x shape: (batch, seq_len, d_model)
@@ -30,7 +44,16 @@ class MemoryAttentionBlock(nn.Module):
     """Attention mechanism over episodic memories"""
     def __init__(self, d_model, n_heads=4, dropout=0.1):
         super().__init__()
-        self.attention = nn.MultiheadAttention(d_model, n_heads, dropout=dropout, batch_first=True)
+        assert d_model % n_heads == 0, "d_model must be divisible by n_heads"
+        self.n_heads = n_heads
+        self.head_dim = d_model // n_heads
+        
+        # Query comes from the perception token; keys/values share one projection
+        self.q_proj = nn.Linear(d_model, d_model)
+        self.kv_proj = nn.Linear(d_model, 2 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+        self.attn_dropout = nn.Dropout(dropout)
+        
         self.norm1 = nn.LayerNorm(d_model)
         self.norm2 = nn.LayerNorm(d_model)
         self.ffn = nn.Sequential(
@@ -41,11 +64,36 @@ class MemoryAttentionBlock(nn.Module):
             nn.Dropout(dropout)
         )
     
-    def forward(self, query, memory, mask=None):
-        # Self-attention with memory as key/value
-        attn_out, attn_weights = self.attention(query, memory, memory, 
-                                                 key_padding_mask=mask,
-                                                 need_weights=True)
+    def _attend(self, query, memory, mask, return_attn):
+        """Multi-head attention of the query token(s) over the memory sequence"""
+        batch_size, seq_len, d_model = memory.shape
+        
+        q = self.q_proj(query).view(batch_size, -1, self.n_heads, self.head_dim).transpose(1, 2)
+        k, v = self.kv_proj(memory).view(
+            batch_size, seq_len, 2, self.n_heads, self.head_dim
+        ).permute(2, 0, 3, 1, 4).unbind(0)  # each (batch, heads, seq_len, head_dim)
+        
+        if not return_attn:
+            # Fused kernel; its boolean mask marks positions that may be attended
+            attn_mask = None if mask is None else ~mask[:, None, None, :]
+            dropout_p = self.attn_dropout.p if self.training else 0.0
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                                 dropout_p=dropout_p)
+            attn = None
+        else:
+            scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.head_dim)
+            if mask is not None:
+                scores = scores.masked_fill(mask[:, None, None, :], float('-inf'))
+            attn = torch.softmax(scores, dim=-1)  # (batch, heads, 1, seq_len)
+            out = torch.matmul(self.attn_dropout(attn), v)  # (batch, heads, 1, head_dim)
+            attn = attn.mean(dim=1)  # (batch, 1, seq_len)
+        
+        out = out.transpose(1, 2).reshape(batch_size, -1, d_model)
+        return self.out_proj(out), attn
+    
+    def forward(self, query, memory, mask=None, return_attn=False):
+        # Attention with memory as key/value; weights are only computed on request
+        attn_out, attn_weights = self._attend(query, memory, mask, return_attn)
         query = self.norm1(query + attn_out)
         
         # Feed-forward
@@ -62,6 +110,7 @@ class NPCBrainModel(nn.Module):
     Input:
         - perception: current perception vector (20 dimensions)
         - memory: sequence of memory embeddings (50 x 32 dimensions)
+        - npc_index: optional personality index when num_npcs > 0
     
     Output:
         - action_probs: probability distribution over 9 actions
@@ -69,7 +118,7 @@ class NPCBrainModel(nn.Module):
     """
     
     def __init__(self, perception_dim=20, memory_seq_len=50, memory_dim=32,
-                 d_model=128, n_heads=4, n_layers=2, dropout=0.1):
+                 d_model=128, n_heads=4, n_layers=2, dropout=0.1, num_npcs=0):
         super().__init__()
         
         self.perception_dim = perception_dim
@@ -92,6 +141,13 @@ class NPCBrainModel(nn.Module):
             nn.Dropout(dropout)
         )
         
+        # Per-NPC personality offsets added to the query; zero-initialized so a
+        # freshly loaded base model behaves identically for every NPC
+        self.num_npcs = num_npcs
+        if num_npcs > 0:
+            self.npc_embedding = nn.Embedding(num_npcs, d_model)
+            nn.init.zeros_(self.npc_embedding.weight)
+        
         # Positional encoding for memory sequence
         self.pos_encoding = PositionalEncoding(d_model, max_len=memory_seq_len)
         
@@ -101,61 +157,65 @@ class NPCBrainModel(nn.Module):
             for _ in range(n_layers)
         ])
         
-        # Output heads
-        self.action_head = nn.Sequential(
+        # Output heads share one trunk over the attended context
+        self.head_trunk = nn.Sequential(
             nn.Linear(d_model, d_model),
             nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(d_model, 9)  # 9 action types
+            nn.Dropout(dropout)
         )
         
+        self.action_head = nn.Linear(d_model, 9)  # 9 action types
+        
         self.emotion_head = nn.Sequential(
-            nn.Linear(d_model, d_model // 2),
-            nn.ReLU(),
-            nn.Dropout(dropout),
-            nn.Linear(d_model // 2, 3),  # valence, arousal, dominance
+            nn.Linear(d_model, 3),  # valence, arousal, dominance
             nn.Tanh()  # Emotions in [-1, 1]
         )
     
-    def forward(self, perception, memory, memory_mask=None):
+    def forward(self, perception, memory, memory_mask=None, npc_index=None, return_attn=False):
         """
         Args:
             perception: (batch, perception_dim)
             memory: (batch, memory_seq_len, memory_dim)
             memory_mask: (batch, memory_seq_len) - True for padding positions
+            npc_index: (batch,) - personality index, only used when num_npcs > 0
+            return_attn: also return attention weights (disables the fused kernel)
         
         Returns:
             action_logits: (batch, 9)
             emotion: (batch, 3)
-            attention_weights: list of (batch, memory_seq_len) from each layer
+            attention_weights: list of (batch, memory_seq_len) from each layer,
+                or None unless return_attn is set
         """
-        # Encode perception as query
-        query = self.perception_encoder(perception)  # (batch, d_model)
-        query = query.unsqueeze(1)  # (batch, 1, d_model)
+        # Encode perception (as query)
+        query = self.perception_encoder(perception).unsqueeze(1)  # (batch, 1, d_model)
+        if npc_index is not None and self.num_npcs > 0:
+            query = query + self.npc_embedding(npc_index).unsqueeze(1)
         
-        # Encode memory sequence
-        batch_size = memory.size(0)
+        # Encode memory
         memory_encoded = self.memory_encoder(memory)  # (batch, seq_len, d_model)
         memory_encoded = self.pos_encoding(memory_encoded)
         
         # Apply attention blocks
-        attention_weights_list = []
+        attention_weights_list = [] if return_attn else None
         for block in self.attention_blocks:
-            query, attn_weights = block(query, memory_encoded, mask=memory_mask)
-            attention_weights_list.append(attn_weights.squeeze(1))  # (batch, seq_len)
+            query, attn_weights = block(query, memory_encoded, mask=memory_mask,
+                                        return_attn=return_attn)
+            if return_attn:
+                attention_weights_list.append(attn_weights.squeeze(1))  # (batch, seq_len)
         
         # Extract final representation
         context = query.squeeze(1)  # (batch, d_model)
         
         # Generate outputs
-        action_logits = self.action_head(context)  # (batch, 9)
-        emotion = self.emotion_head(context)  # (batch, 3)
+        hidden = self.head_trunk(context)  # (batch, d_model)
+        action_logits = self.action_head(hidden)  # (batch, 9)
+        emotion = self.emotion_head(hidden)  # (batch, 3)
         
         return action_logits, emotion, attention_weights_list
 
 
 def create_model(perception_dim=20, memory_seq_len=50, memory_dim=32,
-                 d_model=128, n_heads=4, n_layers=2, dropout=0.1):
+                 d_model=128, n_heads=4, n_layers=2, dropout=0.1, num_npcs=0):
     """Factory function to create model with default parameters"""
     return NPCBrainModel(
         perception_dim=perception_dim,
@@ -164,7 +224,8 @@ def create_model(perception_dim=20, memory_seq_len=50, memory_dim=32,
         d_model=d_model,
         n_heads=n_heads,
         n_layers=n_layers,
-        dropout=dropout
+        dropout=dropout,
+        num_npcs=num_npcs
     )
 
 
@@ -178,7 +239,7 @@ if __name__ == "__main__":
     memory = torch.randn(batch_size, 50, 32)
     
     # Forward pass
-    action_logits, emotion, attention_weights = model(perception, memory)
+    action_logits, emotion, attention_weights = model(perception, memory, return_attn=True)
     
     print(f"Model created successfully!")
     print(f"Action logits shape: {action_logits.shape}")
@@ -9,13 +9,24 @@ import tempfile
 import shutil
 from pathlib import Path
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson is optional
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+# Entries buffered before each write in generate_dummy_data
+_WRITE_BATCH = 4096
+
 def generate_dummy_data(output_dir, num_samples=100):
     """Generate dummy training data in JSONL format"""
     os.makedirs(output_dir, exist_ok=True)
     
     action_types = ['Idle', 'Move', 'Forage', 'Eat', 'Rest', 'Explore', 'Socialize', 'BuildShelter', 'SeekShelter']
     
-    with open(os.path.join(output_dir, 'decisions_test.jsonl'), 'w') as f:
+    buf = bytearray()
+    with open(os.path.join(output_dir, 'decisions_test.jsonl'), 'wb') as f:
         for i in range(num_samples):
             # Generate dummy perception
             perception = {
@@ -60,7 +71,13 @@ def generate_dummy_data(output_dir, num_samples=100):
                 'outcome': outcome
             }
             
-            f.write(json.dumps(entry) + '\n')
+            buf += _json_dumps(entry)
+            buf += b'\n'
+            if (i + 1) % _WRITE_BATCH == 0:
+                f.write(buf)
+                buf.clear()
+        
+        f.write(buf)
     
     print(f"Generated {num_samples} dummy samples in {output_dir}")
 
@@ -120,6 +137,39 @@ def main():
         else:
             print("   ✗ PyTorch checkpoint not found")
         
+        # Precision selection needs no GPU; fake each compute capability
+        print("\n5. Checking mixed precision selection...")
+        import warnings
+        import torch
+        from train_npc_brain import mixed_precision
+        
+        real_capability = torch.cuda.get_device_capability
+        cuda = torch.device('cuda')
+        try:
+            torch.cuda.get_device_capability = lambda device=None: (7, 0)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # GradScaler warns without CUDA
+                amp_dtype, scaler = mixed_precision(cuda)
+            if amp_dtype == torch.float16 and isinstance(scaler, torch.amp.GradScaler):
+                print("   ✓ Pre-Ampere GPU uses fp16 with GradScaler")
+            else:
+                print(f"   ✗ Pre-Ampere GPU got {amp_dtype} with scaler {scaler}")
+            
+            torch.cuda.get_device_capability = lambda device=None: (8, 0)
+            amp_dtype, scaler = mixed_precision(cuda)
+            if amp_dtype == torch.bfloat16 and scaler is None:
+                print("   ✓ Ampere GPU uses bf16 without scaler")
+            else:
+                print(f"   ✗ Ampere GPU got {amp_dtype} with scaler {scaler}")
+        finally:
+            torch.cuda.get_device_capability = real_capability
+        
+        amp_dtype, scaler = mixed_precision(torch.device('cpu'))
+        if amp_dtype is None and scaler is None:
+            print("   ✓ CPU trains in FP32")
+        else:
+            print(f"   ✗ CPU got {amp_dtype} with scaler {scaler}")
+        
         print("\n=== Training Pipeline Test Complete ===")
         print("All components working correctly!")
         
@@ -3,8 +3,9 @@ Train NPC Brain - Bootstrap neural NPC behavior from behavior tree data
 """
 
 import argparse
-import json
+import hashlib
 import os
+import shutil
 import numpy as np
 import torch
 import torch.nn as nn
@@ -12,275 +13,647 @@ import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
 from pathlib import Path
 import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 # Add tools directory to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from model_architecture import create_model
+from export_training_data import iter_jsonl
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to NumPy column fills
+    njit = None
+
+
+# Action type -> class label; unknown actions map to Idle
+_ACTION_MAP = {
+    'Idle': 0,
+    'Move': 1,
+    'Forage': 2,
+    'Eat': 3,
+    'Rest': 4,
+    'Explore': 5,
+    'Socialize': 6,
+    'BuildShelter': 7,
+    'SeekShelter': 8
+}
+
+# Memory recall type -> id stored per memory slot; 0 marks an empty slot
+RECALL_ID = {'food': 1, 'danger': 2, 'npc': 3, 'shelter': 4}
+RECALL_NONE = 0
+
+# Nearby tile type -> count bucket (water, food, shelter); anything else is ignored
+TILE_ID = {'Water': 0, 'BerryBush': 1, 'Tree': 1, 'Cave': 2, 'Shelter': 2}
+TILE_OTHER = 3
+
+# Raw per-sample columns gathered from JSON: x, y, hunger, energy, social,
+# curiosity, safety, time of day, rain flag
+RAW_FEATURES = 9
+
+# Features the perception vector carries before padding/truncation to perception_dim
+PERCEPTION_FEATURES = 16
+
+
+def _extract_perception(perception_data, raw):
+    """Copy the numeric perception fields into a raw row (see RAW_FEATURES)"""
+    pos = perception_data['position']
+    needs = perception_data['needs']
+    raw[:] = (pos['x'], pos['y'],
+              needs['hunger'], needs['energy'], needs['social'], needs['curiosity'],
+              needs['safety'],
+              perception_data.get('timeOfDay', 0.5),
+              1.0 if perception_data.get('weather') == 'rain' else 0.0)
+
+
+def _extract_memory(perception_data, memory_ids):
+    """Write recall type ids (see RECALL_ID) into a zeroed (seq_len,) row"""
+    # In Milestone 1, we don't have memory embeddings yet
+    # Synthesize memory based on memory recalls
+    recalls = perception_data.get('memoryRecalls', [])[:len(memory_ids)]
+    for i, recall in enumerate(recalls):
+        memory_ids[i] = RECALL_ID.get(recall, RECALL_NONE)
+
+
+def recall_codes(memory_dim):
+    """(num ids, memory_dim) table mapping each recall id to its memory vector
+    
+    Id k > 0 sets column k - 1; RECALL_NONE is the all-zero slot.
+    """
+    return np.eye(len(RECALL_ID) + 1, memory_dim, k=-1, dtype=np.float32)
+
+
+def _synthesize_emotion(needs, avg_delta, has_delta):
+    """Bootstrap emotion from outcome (for supervised learning)
+    
+    needs holds (hunger, energy, safety) per sample; avg_delta is the mean
+    needs delta, only meaningful where has_delta is set.
+    """
+    emotion = np.zeros((len(needs), 3), dtype=np.float32)  # valence, arousal, dominance
+    
+    # Valence from need satisfaction
+    # Positive delta = need increased (bad) -> negative valence
+    # Negative delta = need satisfied (good) -> positive valence
+    emotion[:, 0] = np.where(has_delta, -np.tanh(avg_delta), 0.0)
+    
+    # Arousal from need urgency
+    avg_need = needs.mean(axis=1)
+    emotion[:, 1] = np.tanh(avg_need * 2 - 1)  # High needs = high arousal
+    
+    # Dominance from safety
+    emotion[:, 2] = np.tanh(1 - needs[:, 2] * 2)  # Safe = dominant
+    
+    return emotion
+
+
+def _build_features_loop(raw, npc_count, tile_ids, tile_ptr, avg_delta, has_delta,
+                         perception, emotion):
+    """Normalize raw rows into perception and synthesize emotion; each
+    iteration owns one row. Sample i's tiles are tile_ids[tile_ptr[i]:tile_ptr[i + 1]]."""
+    for i in range(raw.shape[0]):
+        # Position (normalized), then needs, time of day and rain as-is
+        perception[i, 0] = raw[i, 0] / 200.0  # Assuming WORLD_WIDTH=200
+        perception[i, 1] = raw[i, 1] / 150.0  # Assuming WORLD_HEIGHT=150
+        for j in range(2, RAW_FEATURES):
+            perception[i, j] = raw[i, j]
+        
+        # Nearby tiles (counts)
+        water_count = 0
+        food_count = 0
+        shelter_count = 0
+        for k in range(tile_ptr[i], tile_ptr[i + 1]):
+            tile = tile_ids[k]
+            if tile == 0:
+                water_count += 1
+            elif tile == 1:
+                food_count += 1
+            elif tile == 2:
+                shelter_count += 1
+        perception[i, 9] = min(1.0, water_count / 5.0)
+        perception[i, 10] = min(1.0, food_count / 5.0)
+        perception[i, 11] = min(1.0, shelter_count / 3.0)
+        
+        # Nearby NPCs; 13-15 stay 0 as the emotion placeholder
+        perception[i, 12] = min(1.0, npc_count[i] / 5.0)
+        
+        # Emotion, as in _synthesize_emotion
+        hunger = raw[i, 2]
+        energy = raw[i, 3]
+        safety = raw[i, 6]
+        emotion[i, 0] = -np.tanh(avg_delta[i]) if has_delta[i] else 0.0
+        emotion[i, 1] = np.tanh((hunger + energy + safety) / 3.0 * 2 - 1)
+        emotion[i, 2] = np.tanh(1 - safety * 2)
+
+
+def _build_features_numpy(raw, npc_count, tile_ids, tile_ptr, avg_delta, has_delta,
+                          perception, emotion):
+    """Normalize raw rows into perception and synthesize emotion by column slab"""
+    n = len(raw)
+    perception[:, 0] = raw[:, 0] / 200.0  # Assuming WORLD_WIDTH=200
+    perception[:, 1] = raw[:, 1] / 150.0  # Assuming WORLD_HEIGHT=150
+    perception[:, 2:RAW_FEATURES] = raw[:, 2:]
+    
+    # One bincount over (sample, bucket) pairs counts every sample's tiles
+    tile_rows = np.repeat(np.arange(n), np.diff(tile_ptr))
+    tile_counts = np.bincount(tile_rows * (TILE_OTHER + 1) + tile_ids,
+                              minlength=n * (TILE_OTHER + 1)).reshape(n, TILE_OTHER + 1)
+    perception[:, 9:12] = np.minimum(1.0, tile_counts[:, :TILE_OTHER] / [5.0, 5.0, 3.0])
+    perception[:, 12] = np.minimum(1.0, npc_count / 5.0)
+    
+    emotion[:] = _synthesize_emotion(raw[:, [2, 3, 6]], avg_delta, has_delta)
+
+
+# Compiled without parallel=True: files are already parsed in parallel
+# processes, and numba's thread pool is not safe to fork into DataLoader workers
+if njit is not None:
+    _build_features = njit(cache=True, fastmath=True)(_build_features_loop)
+else:
+    _build_features = _build_features_numpy
+
+
+def _encode_samples(samples, perception_dim, memory_seq_len):
+    """Decode parsed log entries into per-sample arrays
+    
+    Returns (perception, memory_ids, actions, emotion, npc_ids).
+    """
+    n = len(samples)
+    memory_ids = np.zeros((n, memory_seq_len), dtype=np.int8)
+    encode = _ACTION_MAP.get
+    actions = np.fromiter((encode(sample['decision']['type'], 0) for sample in samples),
+                          dtype=np.int64, count=n)
+    npc_ids = np.array([sample.get('npcId', -1) for sample in samples], dtype=np.int64)
+    
+    # The Python pass only gathers raw numbers; _build_features does the math
+    raw = np.empty((n, RAW_FEATURES), dtype=np.float32)
+    npc_count = np.empty(n, dtype=np.int64)
+    avg_delta = np.zeros(n, dtype=np.float32)
+    has_delta = np.zeros(n, dtype=np.bool_)
+    tile_ids = []
+    tile_ptr = np.zeros(n + 1, dtype=np.int64)  # CSR offsets into tile_ids
+    
+    for i, sample in enumerate(samples):
+        perception_data = sample['perception']
+        _extract_perception(perception_data, raw[i])
+        npc_count[i] = len(perception_data.get('nearbyNPCs', []))
+        tiles = perception_data.get('nearbyTiles', [])
+        tile_ids.extend(TILE_ID.get(tile.get('type'), TILE_OTHER) for tile in tiles)
+        tile_ptr[i + 1] = len(tile_ids)
+        _extract_memory(perception_data, memory_ids[i])
+        
+        need_deltas = sample.get('outcome', {}).get('needsDeltas', {})
+        if need_deltas:
+            avg_delta[i] = sum(need_deltas.values()) / len(need_deltas)
+            has_delta[i] = True
+    
+    # Full-width rows, cut down to perception_dim at the end
+    perception = np.zeros((n, max(perception_dim, PERCEPTION_FEATURES)), dtype=np.float32)
+    emotion = np.zeros((n, 3), dtype=np.float32)
+    _build_features(raw, npc_count, np.array(tile_ids, dtype=np.int8), tile_ptr,
+                    avg_delta, has_delta, perception, emotion)
+    if perception.shape[1] > perception_dim:
+        perception = np.ascontiguousarray(perception[:, :perception_dim])
+    
+    return perception, memory_ids, actions, emotion, npc_ids
+
+
+def _parse_file(filepath, perception_dim, memory_seq_len, npc_id_filter=None):
+    """Parse one decision log straight into arrays (see _encode_samples)
+    
+    Module level so it can be shipped to worker processes.
+    """
+    # Drop other NPCs' rows at parse time when filtering
+    samples = [entry for entry in iter_jsonl(filepath)
+               if npc_id_filter is None or entry.get('npcId') in npc_id_filter]
+    return _encode_samples(samples, perception_dim, memory_seq_len)
+
+
+# Arrays persisted by the NPCDataset cache
+_CACHE_FIELDS = ('perception', 'memory_ids', 'actions', 'emotion', 'sample_npc_ids')
+
+# Bump when the decoding changes so stale caches are ignored
+_CACHE_VERSION = 2
+
+
+def _cache_key(decision_files, perception_dim, memory_seq_len, npc_id_filter):
+    """Short hash identifying one decoded view of a set of log files"""
+    digest = hashlib.sha1()
+    for filepath in decision_files:
+        stat = os.stat(filepath)
+        digest.update(f"{Path(filepath).name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    npc_ids = None if npc_id_filter is None else sorted(npc_id_filter)
+    digest.update(repr((_CACHE_VERSION, perception_dim, memory_seq_len, npc_ids)).encode())
+    return digest.hexdigest()[:16]
 
 
 class NPCDataset(Dataset):
-    """Dataset for NPC perception-action-outcome sequences"""
+    """Dataset for NPC perception-action-outcome sequences
+    
+    Every sample is decoded once at load time into contiguous arrays, so
+    __getitem__ is just a slice wrapped with torch.from_numpy. Memory is
+    kept as one int8 recall id per slot and expanded to memory_dim floats
+    only when a sample is fetched.
+    """
     
-    def __init__(self, data_dir, perception_dim=20, memory_seq_len=50, memory_dim=32):
+    def __init__(self, data_dir, perception_dim=20, memory_seq_len=50, memory_dim=32,
+                 npc_id_filter=None, cache=True):
         self.perception_dim = perception_dim
         self.memory_seq_len = memory_seq_len
         self.memory_dim = memory_dim
         
-        # Load JSONL decision logs
-        self.samples = []
-        decision_files = list(Path(data_dir).glob("decisions_*.jsonl"))
+        # npc_id_filter may be a single NPC ID or a collection of them
+        if npc_id_filter is not None and not isinstance(npc_id_filter, (set, frozenset, list, tuple)):
+            npc_id_filter = {npc_id_filter}
+        
+        self._recall_codes = recall_codes(memory_dim)
+        
+        decision_files = sorted(Path(data_dir).glob("decisions_*.jsonl"))
+        
+        # Decoded arrays are cached next to the logs, keyed by the log files'
+        # names, sizes and mtimes plus everything that shapes the arrays
+        cache_dir = None
+        if cache and decision_files:
+            key = _cache_key(decision_files, perception_dim, memory_seq_len, npc_id_filter)
+            cache_dir = Path(data_dir) / f"_cache_{key}"
+        
+        if cache_dir is not None and cache_dir.is_dir():
+            print(f"Loading cached dataset from {cache_dir}")
+            # Copy-on-write maps page in lazily and stay writable for torch.from_numpy
+            for name in _CACHE_FIELDS:
+                setattr(self, name, np.load(cache_dir / f"{name}.npy", mmap_mode='c'))
+        else:
+            self._parse_files(decision_files, npc_id_filter)
+            if cache_dir is not None:
+                self._save_cache(cache_dir)
+        
+        # Most samples recall nothing; those all share one zero memory
+        # tensor instead of expanding a fresh (seq_len, memory_dim) array.
+        # Collation copies it into the batch, so sharing is safe.
+        self._has_recalls = self.memory_ids.any(axis=1)
+        self._zero_memory = torch.zeros(memory_seq_len, memory_dim)
+        
+        # Row indices by NPC so per-NPC views never rescan the samples
+        self._by_npc = defaultdict(list)
+        for i, npc_id in enumerate(self.sample_npc_ids.tolist()):
+            self._by_npc[npc_id].append(i)
+        
+        print(f"Loaded {len(self.actions)} training samples")
+    
+    def _parse_files(self, decision_files, npc_id_filter):
+        """Decode JSONL decision logs into arrays, one file per worker process"""
+        perception_dim, memory_seq_len = self.perception_dim, self.memory_seq_len
         
         print(f"Loading data from {len(decision_files)} files...")
-        for filepath in decision_files:
-            with open(filepath, 'r') as f:
-                for line in f:
-                    try:
-                        entry = json.loads(line.strip())
-                        self.samples.append(entry)
-                    except json.JSONDecodeError:
-                        continue
-        
-        print(f"Loaded {len(self.samples)} training samples")
+        parse = partial(_parse_file, perception_dim=perception_dim, memory_seq_len=memory_seq_len,
+                        npc_id_filter=npc_id_filter)
+        max_workers = min(len(decision_files), os.cpu_count() or 1)
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(parse, decision_files))
+        else:
+            results = [parse(filepath) for filepath in decision_files]
+        if not results:
+            results = [_encode_samples([], perception_dim, memory_seq_len)]
+        
+        perception, memory_ids, actions, emotion, npc_ids = zip(*results)
+        self.perception = np.concatenate(perception)
+        self.memory_ids = np.concatenate(memory_ids)
+        self.actions = np.concatenate(actions)
+        self.emotion = np.concatenate(emotion)
+        self.sample_npc_ids = np.concatenate(npc_ids)
+    
+    def _save_cache(self, cache_dir):
+        """Write the decoded arrays to cache_dir; caching is best effort"""
+        tmp_dir = None
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp_cache_', dir=cache_dir.parent)
+            for name in _CACHE_FIELDS:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+            # Publish atomically so a half-written cache is never loaded
+            os.replace(tmp_dir, cache_dir)
+        except OSError as e:
+            print(f"Warning: could not write dataset cache ({e})")
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    def indices_for(self, npc_id):
+        """Sample indices belonging to one NPC"""
+        return self._by_npc.get(npc_id, [])
     
     def __len__(self):
-        return len(self.samples)
+        return len(self.actions)
     
     def __getitem__(self, idx):
-        sample = self.samples[idx]
-        
-        # Extract perception features
-        perception = self._extract_perception(sample['perception'])
-        
-        # Extract or synthesize memory context
-        memory = self._extract_memory(sample)
-        
-        # Extract action label
-        action_label = self._action_to_label(sample['decision']['type'])
-        
-        # Extract or synthesize emotion (bootstrap from outcome)
-        emotion = self._synthesize_emotion(sample)
-        
+        if self._has_recalls[idx]:
+            memory = torch.from_numpy(self._recall_codes[self.memory_ids[idx]])
+        else:
+            memory = self._zero_memory
+        # [idx, ...] yields a 0-d array view rather than a numpy scalar, so the
+        # label is wrapped by from_numpy too instead of a copying factory
         return {
-            'perception': torch.tensor(perception, dtype=torch.float32),
-            'memory': torch.tensor(memory, dtype=torch.float32),
-            'action_label': torch.tensor(action_label, dtype=torch.long),
-            'emotion': torch.tensor(emotion, dtype=torch.float32)
+            'perception': torch.from_numpy(self.perception[idx]),
+            'memory': memory,
+            'action_label': torch.from_numpy(self.actions[idx, ...]),
+            'emotion': torch.from_numpy(self.emotion[idx])
         }
+
+
+def compile_for_training(model, device, enabled=None):
+    """Wrap model with torch.compile for graph-level fusion
     
-    def _extract_perception(self, perception_data):
-        """Convert perception JSON to vector"""
-        vec = []
-        
-        # Position (normalized)
-        pos = perception_data['position']
-        vec.append(pos['x'] / 200.0)  # Assuming WORLD_WIDTH=200
-        vec.append(pos['y'] / 150.0)  # Assuming WORLD_HEIGHT=150
-        
-        # Needs
-        needs = perception_data['needs']
-        vec.append(needs['hunger'])
-        vec.append(needs['energy'])
-        vec.append(needs['social'])
-        vec.append(needs['curiosity'])
-        vec.append(needs['safety'])
-        
-        # Time and weather
-        vec.append(perception_data.get('timeOfDay', 0.5))
-        vec.append(1.0 if perception_data.get('weather') == 'rain' else 0.0)
-        
-        # Nearby tiles (counts)
-        nearby_tiles = perception_data.get('nearbyTiles', [])
-        water_count = sum(1 for t in nearby_tiles if t.get('type') == 'Water')
-        food_count = sum(1 for t in nearby_tiles if t.get('type') in ['BerryBush', 'Tree'])
-        shelter_count = sum(1 for t in nearby_tiles if t.get('type') in ['Cave', 'Shelter'])
-        
-        vec.append(min(1.0, water_count / 5.0))
-        vec.append(min(1.0, food_count / 5.0))
-        vec.append(min(1.0, shelter_count / 3.0))
-        
-        # Nearby NPCs
-        nearby_npcs = perception_data.get('nearbyNPCs', [])
-        vec.append(min(1.0, len(nearby_npcs) / 5.0))
-        
-        # Emotion placeholder (bootstrapped to 0 initially)
-        vec.extend([0.0, 0.0, 0.0])
-        
-        # Pad to fixed size
-        while len(vec) < self.perception_dim:
-            vec.append(0.0)
-        
-        return vec[:self.perception_dim]
+    By default this only happens on CUDA, where cutting kernel launches pays
+    back the compile time. The returned module shares parameters with model,
+    so the uncompiled original stays usable for saving and ONNX export.
+    """
+    if enabled is None:
+        enabled = device.type == 'cuda'
+    if not enabled or not hasattr(torch, 'compile'):
+        return model
+    return torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+
+def bf16_autocast_dtype(device):
+    """bfloat16 when the device runs it natively (Ampere+ GPUs), otherwise None
     
-    def _extract_memory(self, sample):
-        """Extract or synthesize memory sequence"""
-        # In Milestone 1, we don't have memory embeddings yet
-        # Synthesize memory based on memory recalls
-        memory = np.zeros((self.memory_seq_len, self.memory_dim), dtype=np.float32)
-        
-        recalls = sample['perception'].get('memoryRecalls', [])
-        for i, recall in enumerate(recalls[:self.memory_seq_len]):
-            # Simple encoding of memory type
-            if recall == 'food':
-                memory[i, 0] = 1.0
-            elif recall == 'danger':
-                memory[i, 1] = 1.0
-            elif recall == 'npc':
-                memory[i, 2] = 1.0
-            elif recall == 'shelter':
-                memory[i, 3] = 1.0
-            
-            # Add some random noise to create embedding-like structure
-            memory[i, 4:] = np.random.randn(self.memory_dim - 4) * 0.1
-        
-        return memory
-    
-    def _action_to_label(self, action_type):
-        """Convert action type string to label index"""
-        action_map = {
-            'Idle': 0,
-            'Move': 1,
-            'Forage': 2,
-            'Eat': 3,
-            'Rest': 4,
-            'Explore': 5,
-            'Socialize': 6,
-            'BuildShelter': 7,
-            'SeekShelter': 8
-        }
-        return action_map.get(action_type, 0)
+    torch.cuda.is_bf16_supported() also reports emulated bf16 on older GPUs,
+    so check the compute capability instead.
+    """
+    if device.type == 'cuda' and torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.bfloat16
+    return None
+
+
+def make_loader(dataset, batch_size, device, shuffle):
+    """DataLoader with pinned memory on CUDA
     
-    def _synthesize_emotion(self, sample):
-        """Bootstrap emotion from outcome (for supervised learning)"""
-        emotion = [0.0, 0.0, 0.0]  # valence, arousal, dominance
-        
-        # Infer emotion from needs and outcome
-        needs = sample['perception']['needs']
-        outcome = sample.get('outcome', {})
-        
-        # Valence from need satisfaction
-        # Positive delta = need increased (bad) -> negative valence
-        # Negative delta = need satisfied (good) -> positive valence
-        need_deltas = outcome.get('needsDeltas', {})
-        if need_deltas:
-            avg_delta = np.mean([delta for delta in need_deltas.values()])
-            emotion[0] = -np.tanh(avg_delta)  # Negate: negative delta = positive valence
-        
-        # Arousal from need urgency
-        avg_need = (needs['hunger'] + needs['energy'] + needs['safety']) / 3.0
-        emotion[1] = np.tanh(avg_need * 2 - 1)  # High needs = high arousal
-        
-        # Dominance from safety
-        emotion[2] = np.tanh(1 - needs['safety'] * 2)  # Safe = dominant
-        
-        return emotion
+    NPCDataset rows are slices of in-memory arrays, so batches are built in
+    process; worker processes would only add startup and pickling cost.
+    """
+    # Pinned host batches let the .to(device, non_blocking=True) copies overlap compute
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      pin_memory=(device.type == 'cuda'))
+
+
+class CUDAPrefetcher:
+    """Iterate a DataLoader, uploading batch k+1 on a side stream while batch k runs
+    
+    Yields the same dicts as the loader with every tensor already on device.
+    The loader should pin memory so the copies are truly asynchronous.
+    """
+    
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            batch = next_batch
+            # Tell the allocator these side-stream buffers are in use on the compute stream
+            for tensor in batch.values():
+                tensor.record_stream(current)
+            next_batch = self._preload(batches)
+            yield batch
+    
+    def _preload(self, batches):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return {key: value.to(self.device, non_blocking=True) for key, value in batch.items()}
 
 
-def train_epoch(model, dataloader, optimizer, criterion_action, criterion_emotion, device):
-    """Train for one epoch"""
+class ResidentLoader:
+    """DataLoader stand-in serving batches from arrays uploaded to device once
+    
+    Takes an NPCDataset and the rows to serve (e.g. a random_split subset's
+    indices). Each batch is a gather from device-resident tensors, so there
+    are no workers, pinned buffers or per-batch host-to-device copies.
+    Memory stays as int8 recall ids on device and is expanded per batch.
+    """
+    
+    def __init__(self, dataset, indices, batch_size, device, shuffle):
+        rows = torch.as_tensor(indices, dtype=torch.long)
+        self.perception = torch.from_numpy(dataset.perception)[rows].to(device)
+        self.memory_ids = torch.from_numpy(dataset.memory_ids)[rows].to(device)
+        self.actions = torch.from_numpy(dataset.actions)[rows].to(device)
+        self.emotion = torch.from_numpy(dataset.emotion)[rows].to(device)
+        self.recall_codes = torch.from_numpy(dataset._recall_codes).to(device)
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+    
+    def __len__(self):
+        return (len(self.actions) + self.batch_size - 1) // self.batch_size
+    
+    def __iter__(self):
+        n = len(self.actions)
+        if self.shuffle:
+            order = torch.randperm(n, device=self.device)
+        else:
+            order = torch.arange(n, device=self.device)
+        for start in range(0, n, self.batch_size):
+            idx = order[start:start + self.batch_size]
+            yield {
+                'perception': self.perception[idx],
+                'memory': self.recall_codes[self.memory_ids[idx].long()],
+                'action_label': self.actions[idx],
+                'emotion': self.emotion[idx]
+            }
+
+
+def _device_batches(dataloader, device):
+    """Batches from dataloader, prefetched onto the GPU when training on CUDA"""
+    if device.type == 'cuda' and not isinstance(dataloader, ResidentLoader):
+        return CUDAPrefetcher(dataloader, device)
+    return dataloader
+
+
+def mixed_precision(device):
+    """Autocast dtype and GradScaler for training on device
+    
+    bf16 where the GPU runs it natively, fp16 with loss scaling on other
+    GPUs, and plain FP32 on CPU. The scaler is None unless fp16 is used.
+    """
+    amp_dtype = bf16_autocast_dtype(device)
+    if amp_dtype is None and device.type == 'cuda':
+        amp_dtype = torch.float16
+    scaler = torch.amp.GradScaler('cuda') if amp_dtype == torch.float16 else None
+    return amp_dtype, scaler
+
+
+def train_epoch(model, dataloader, optimizer, criterion_action, criterion_emotion, device,
+                amp_dtype=None, scaler=None):
+    """Train for one epoch
+    
+    With amp_dtype (e.g. torch.bfloat16) the forward pass and losses run
+    under torch.autocast; bf16 keeps FP32's range, so no grad scaling.
+    float16 needs a GradScaler passed as scaler to keep gradients from
+    underflowing.
+    """
     model.train()
-    total_loss = 0.0
-    total_action_loss = 0.0
-    total_emotion_loss = 0.0
-    correct = 0
+    # Running sums stay on device; reading them once per epoch avoids a
+    # host sync on every batch
+    total_loss = torch.zeros((), device=device)
+    total_action_loss = torch.zeros((), device=device)
+    total_emotion_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
     
-    for batch in dataloader:
-        perception = batch['perception'].to(device)
-        memory = batch['memory'].to(device)
-        action_label = batch['action_label'].to(device)
-        emotion_target = batch['emotion'].to(device)
-        
-        optimizer.zero_grad()
-        
-        # Forward pass
-        action_logits, emotion_pred, _ = model(perception, memory)
-        
-        # Compute losses
-        loss_action = criterion_action(action_logits, action_label)
-        loss_emotion = criterion_emotion(emotion_pred, emotion_target)
-        
-        # Combined loss (weighted)
-        loss = loss_action + 0.5 * loss_emotion
+    for batch in _device_batches(dataloader, device):
+        perception = batch['perception'].to(device, non_blocking=True)
+        memory = batch['memory'].to(device, non_blocking=True)
+        action_label = batch['action_label'].to(device, non_blocking=True)
+        emotion_target = batch['emotion'].to(device, non_blocking=True)
+        npc_index = batch['npc_index'].to(device, non_blocking=True) if 'npc_index' in batch else None
+        
+        optimizer.zero_grad(set_to_none=True)
+        
+        with torch.autocast(device_type=device.type, dtype=amp_dtype,
+                            enabled=amp_dtype is not None):
+            # Forward pass
+            action_logits, emotion_pred, _ = model(perception, memory, npc_index=npc_index)
+            
+            # Compute losses
+            loss_action = criterion_action(action_logits, action_label)
+            loss_emotion = criterion_emotion(emotion_pred, emotion_target)
+            
+            # Combined loss (weighted), scale and add in one op
+            loss = torch.add(loss_action, loss_emotion, alpha=0.5)
         
         # Backward pass
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
         
         # Statistics
-        total_loss += loss.item()
-        total_action_loss += loss_action.item()
-        total_emotion_loss += loss_emotion.item()
+        total_loss += loss.detach()
+        total_action_loss += loss_action.detach()
+        total_emotion_loss += loss_emotion.detach()
         
         _, predicted = torch.max(action_logits, 1)
-        correct += (predicted == action_label).sum().item()
+        correct += (predicted == action_label).sum()
         total += action_label.size(0)
     
-    avg_loss = total_loss / len(dataloader)
-    avg_action_loss = total_action_loss / len(dataloader)
-    avg_emotion_loss = total_emotion_loss / len(dataloader)
-    accuracy = 100.0 * correct / total if total > 0 else 0
+    avg_loss = total_loss.item() / len(dataloader)
+    avg_action_loss = total_action_loss.item() / len(dataloader)
+    avg_emotion_loss = total_emotion_loss.item() / len(dataloader)
+    accuracy = 100.0 * correct.item() / total if total > 0 else 0
     
     return avg_loss, avg_action_loss, avg_emotion_loss, accuracy
 
 
-def validate(model, dataloader, criterion_action, criterion_emotion, device):
+def validate(model, dataloader, criterion_action, criterion_emotion, device, amp_dtype=None):
     """Validate model"""
     model.eval()
-    total_loss = 0.0
-    correct = 0
+    total_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
     
     with torch.no_grad():
-        for batch in dataloader:
-            perception = batch['perception'].to(device)
-            memory = batch['memory'].to(device)
-            action_label = batch['action_label'].to(device)
-            emotion_target = batch['emotion'].to(device)
-            
-            action_logits, emotion_pred, _ = model(perception, memory)
+        for batch in _device_batches(dataloader, device):
+            perception = batch['perception'].to(device, non_blocking=True)
+            memory = batch['memory'].to(device, non_blocking=True)
+            action_label = batch['action_label'].to(device, non_blocking=True)
+            emotion_target = batch['emotion'].to(device, non_blocking=True)
+            npc_index = batch['npc_index'].to(device, non_blocking=True) if 'npc_index' in batch else None
             
-            loss_action = criterion_action(action_logits, action_label)
-            loss_emotion = criterion_emotion(emotion_pred, emotion_target)
-            loss = loss_action + 0.5 * loss_emotion
+            with torch.autocast(device_type=device.type, dtype=amp_dtype,
+                                enabled=amp_dtype is not None):
+                action_logits, emotion_pred, _ = model(perception, memory, npc_index=npc_index)
+                
+                loss_action = criterion_action(action_logits, action_label)
+                loss_emotion = criterion_emotion(emotion_pred, emotion_target)
+                loss = torch.add(loss_action, loss_emotion, alpha=0.5)
             
-            total_loss += loss.item()
+            total_loss += loss
             
             _, predicted = torch.max(action_logits, 1)
-            correct += (predicted == action_label).sum().item()
+            correct += (predicted == action_label).sum()
             total += action_label.size(0)
     
-    avg_loss = total_loss / len(dataloader) if len(dataloader) > 0 else 0
-    accuracy = 100.0 * correct / total if total > 0 else 0
+    avg_loss = total_loss.item() / len(dataloader) if len(dataloader) > 0 else 0
+    accuracy = 100.0 * correct.item() / total if total > 0 else 0
     
     return avg_loss, accuracy
 
 
+class _InferenceHead(nn.Module):
+    """Single-output view of the model in the layout NeuralBrain.cpp reads
+    
+    output[:, :9] holds action probabilities and output[:, 9:12] the
+    emotion (valence, arousal, dominance), so the runtime needs no softmax.
+    """
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, perception, memory):
+        action_logits, emotion, _ = self.model(perception, memory)
+        return torch.cat([torch.softmax(action_logits, dim=-1), emotion], dim=-1)
+
+
 def export_to_onnx(model, output_path, perception_dim=20, memory_seq_len=50, memory_dim=32):
     """Export trained model to ONNX format"""
     model.eval()
     
-    # Create dummy inputs
-    dummy_perception = torch.randn(1, perception_dim)
-    dummy_memory = torch.randn(1, memory_seq_len, memory_dim)
+    # Create dummy inputs (batch of 2: the exporter specializes size-1 dims,
+    # which would pin the dynamic batch axis to 1)
+    dummy_perception = torch.randn(2, perception_dim)
+    dummy_memory = torch.randn(2, memory_seq_len, memory_dim)
+    batch = torch.export.Dim('batch')
     
-    # Export
+    # Export through the dynamo exporter at opset 18, its native opset, so
+    # no version down-conversion runs; the graph is optimized and constant
+    # folded on the way out and written as one self-contained file
     torch.onnx.export(
-        model,
+        _InferenceHead(model).eval(),
         (dummy_perception, dummy_memory),
         output_path,
         input_names=['perception', 'memory'],
         output_names=['output'],
-        dynamic_axes={
-            'perception': {0: 'batch'},
-            'memory': {0: 'batch'},
-            'output': {0: 'batch'}
-        },
-        opset_version=12
+        dynamic_shapes={'perception': {0: batch}, 'memory': {0: batch}},
+        opset_version=18,
+        dynamo=True,
+        optimize=True,
+        external_data=False
     )
     
     print(f"Model exported to {output_path}")
 
 
+def quantize_onnx(onnx_path):
+    """Quantize an exported ONNX model to int8 weights with dynamic activations"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    
+    int8_path = os.path.splitext(onnx_path)[0] + '.int8.onnx'
+    
+    # Shape inference + graph cleanup first so every MatMul gets quantized
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        preprocessed_path = os.path.join(tmp_dir, 'preprocessed.onnx')
+        quant_pre_process(onnx_path, preprocessed_path)
+        quantize_dynamic(preprocessed_path, int8_path, weight_type=QuantType.QInt8)
+    
+    print(f"Quantized model exported to {int8_path}")
+    return int8_path
+
+
 def main():
     parser = argparse.ArgumentParser(description='Train NPC Brain')
     parser.add_argument('--data-dir', type=str, default='data_logs',
@@ -295,6 +668,10 @@ def main():
                         help='Learning rate')
     parser.add_argument('--device', type=str, default='cpu',
                         help='Device to use (cpu or cuda)')
+    parser.add_argument('--compile', dest='compile_model', action='store_const', const=True,
+                        default=None, help='Train through torch.compile (default: CUDA only)')
+    parser.add_argument('--no-compile', dest='compile_model', action='store_const', const=False,
+                        help='Never use torch.compile')
     
     args = parser.parse_args()
     
@@ -304,6 +681,12 @@ def main():
     # Set device
     device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}")
+    if device.type == 'cuda':
+        # Input shapes are fixed, so autotuned kernels are picked once and
+        # reused; TF32 covers whatever still runs in FP32 under autocast
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
     
     # Load dataset
     print("Loading dataset...")
@@ -321,8 +704,15 @@ def main():
         dataset, [train_size, val_size]
     )
     
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False)
+    if device.type == 'cuda':
+        # Decision logs are small; keep both splits resident on the GPU
+        train_loader = ResidentLoader(dataset, train_dataset.indices, args.batch_size, device,
+                                      shuffle=True)
+        val_loader = ResidentLoader(dataset, val_dataset.indices, args.batch_size, device,
+                                    shuffle=False)
+    else:
+        train_loader = make_loader(train_dataset, args.batch_size, device, shuffle=True)
+        val_loader = make_loader(val_dataset, args.batch_size, device, shuffle=False)
     
     print(f"Train samples: {train_size}, Validation samples: {val_size}")
     
@@ -334,21 +724,26 @@ def main():
     # Loss functions and optimizer
     criterion_action = nn.CrossEntropyLoss()
     criterion_emotion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, fused=(device.type == 'cuda'))
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', 
                                                        factor=0.5, patience=5)
     
+    # Compiled copy for training only; saving and ONNX export use model
+    train_model = compile_for_training(model, device, args.compile_model)
+    amp_dtype, scaler = mixed_precision(device)
+    
     # Training loop
     print("\nStarting training...")
     best_val_loss = float('inf')
     
     for epoch in range(args.epochs):
         train_loss, train_action_loss, train_emotion_loss, train_acc = train_epoch(
-            model, train_loader, optimizer, criterion_action, criterion_emotion, device
+            train_model, train_loader, optimizer, criterion_action, criterion_emotion, device,
+            amp_dtype, scaler
         )
         
         val_loss, val_acc = validate(
-            model, val_loader, criterion_action, criterion_emotion, device
+            train_model, val_loader, criterion_action, criterion_emotion, device, amp_dtype
         )
         
         scheduler.step(val_loss)